@@ -1,11 +1,14 @@
 import streamlit as st
 import cv2
-import numpy as np
 import os
 import tempfile
-import base64
-from tracker import EuclideanDistTracker
-from streamlit.components.v1 import html
+import shutil
+from pipeline import OPENCV_THREADS_PER_CORE, VideoProcessingError, mask_preview, process_video_file
+
+# Let OpenCV use every core, with OPENCV_THREADS_PER_CORE threads each, and dispatch
+# to OpenCL devices when available
+cv2.setNumThreads(OPENCV_THREADS_PER_CORE * (os.cpu_count() or 1))
+cv2.ocl.setUseOpenCL(True)
 
 # Set page configuration for a professional look
 st.set_page_config(
@@ -53,11 +56,69 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
-# Function to convert video file to base64
-def video_to_base64(file_path):
-    with open(file_path, "rb") as video_file:
-        video_bytes = video_file.read()
-    return base64.b64encode(video_bytes).decode()
+# Each processing run writes its outputs to its own directory under OUTPUT_ROOT.
+# Only the newest CACHE_ENTRIES directories are kept, matching the size of the result cache
+OUTPUT_ROOT = os.path.join(tempfile.gettempdir(), "object_tracking_outputs")
+CACHE_ENTRIES = 8
+
+# Modification time of an output directory, or 0 if another session has just deleted it
+def output_dir_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return 0
+
+# Function to delete the oldest output directories so that a new one fits.
+# Directories are touched whenever their cached result is shown, so the oldest is the least recently used
+def prune_output_dirs():
+    os.makedirs(OUTPUT_ROOT, exist_ok=True)
+    dirs = [os.path.join(OUTPUT_ROOT, d) for d in os.listdir(OUTPUT_ROOT)]
+    dirs.sort(key=output_dir_mtime, reverse=True)
+    for d in dirs[CACHE_ENTRIES - 1:]:
+        shutil.rmtree(d, ignore_errors=True)
+
+# Track objects in a video and return the paths of the tracked, ROI and lossless mask videos.
+# Results are cached on the video bytes, ROI and detection scale, so reruns caused by
+# unrelated widget changes reuse the existing outputs instead of processing again
+@st.cache_data(show_spinner=False, max_entries=CACHE_ENTRIES)
+def process_video(video_bytes, roi_box, detection_scale):
+    prune_output_dirs()
+    output_dir = tempfile.mkdtemp(dir=OUTPUT_ROOT)
+    video_path = os.path.join(output_dir, "input.mp4")
+    tracked_output_file = os.path.join(output_dir, "tracked.mp4")
+    roi_output_file = os.path.join(output_dir, "roi.mp4")
+    mask_output_file = os.path.join(output_dir, "mask.mkv")
+    output_files = (tracked_output_file, roi_output_file, mask_output_file)
+
+    success = False
+    try:
+        # Save uploaded video to a temporary file
+        with open(video_path, "wb") as tfile:
+            tfile.write(video_bytes)
+
+        # Progress bar and status. They live in a placeholder that is emptied when processing
+        # ends, so a cache hit replays an empty placeholder instead of a finished progress bar
+        progress_area = st.empty()
+        with progress_area.container():
+            st.write("### Processing Video")
+            progress_bar = st.progress(0)
+            status_text = st.empty()
+
+        def show_progress(processed_frames, frame_count):
+            progress = min(processed_frames / max(frame_count, 1), 1.0)
+            progress_bar.progress(progress)
+            status_text.text(f"Processing frame {processed_frames}/{frame_count} ({int(progress*100)}%)")
+
+        process_video_file(video_path, output_files, roi_box, detection_scale, progress=show_progress)
+        progress_area.empty()
+        success = True
+    finally:
+        if os.path.exists(video_path):
+            os.unlink(video_path)
+        if not success:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    return output_files
 
 # App header
 st.title("📹 Object Tracking Dashboard")
@@ -74,6 +135,10 @@ roi_y_end = st.sidebar.slider("ROI Y-End", 0, 1080, 720, help="Ending Y-coordina
 roi_x_start = st.sidebar.slider("ROI X-Start", 0, 1920, 500, help="Starting X-coordinate for ROI")
 roi_x_end = st.sidebar.slider("ROI X-End", 0, 1920, 800, help="Ending X-coordinate for ROI")
 
+# Detection parameters
+st.sidebar.subheader("Detection")
+detection_scale = st.sidebar.select_slider("Detection Downscale", options=[1, 2, 4], value=2, help="Run background subtraction on the ROI shrunk by this factor; higher is faster but misses small objects")
+
 # File uploader
 uploaded_file = st.file_uploader(
     "Upload a video file (MP4, AVI, MOV)",
@@ -83,171 +148,44 @@ uploaded_file = st.file_uploader(
 
 if uploaded_file is not None:
     try:
-        # Save uploaded video to a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as tfile:
-            tfile.write(uploaded_file.read())
-            video_path = tfile.name
-
-        # Initialize video capture
-        cap = cv2.VideoCapture(video_path)
-        if not cap.isOpened():
-            st.error("Error: Could not open video file.")
-            os.unlink(video_path)
-            st.stop()
-
-        # Get video properties
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        fps = int(cap.get(cv2.CAP_PROP_FPS))
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-
-        # Validate ROI
-        if roi_y_end <= roi_y_start or roi_x_end <= roi_x_start:
-            st.error("Invalid ROI: End coordinates must be greater than start coordinates.")
-            cap.release()
-            os.unlink(video_path)
-            st.stop()
-        if roi_y_end > height or roi_x_end > width:
-            st.error(f"ROI exceeds video dimensions (width: {width}, height: {height}).")
-            cap.release()
-            os.unlink(video_path)
-            st.stop()
-
-        # Initialize tracker and detector
-        tracker = EuclideanDistTracker()
-        object_detector = cv2.createBackgroundSubtractorMOG2(history=100, varThreshold=40)
-
-        # Create temporary files for output videos
-        tracked_output_file = tempfile.NamedTemporaryFile(delete=False, suffix='.mp4').name
-        roi_output_file = tempfile.NamedTemporaryFile(delete=False, suffix='.mp4').name
-        mask_output_file = tempfile.NamedTemporaryFile(delete=False, suffix='.mp4').name
-
-        fourcc = cv2.VideoWriter_fourcc(*'H264')
-        tracked_out = cv2.VideoWriter(tracked_output_file, fourcc, fps, (width, height))
-        roi_out = cv2.VideoWriter(roi_output_file, fourcc, fps, (roi_x_end - roi_x_start, roi_y_end - roi_y_start))
-        mask_out = cv2.VideoWriter(mask_output_file, fourcc, fps, (roi_x_end - roi_x_start, roi_y_end - roi_y_start), isColor=False)
-
-        if not (tracked_out.isOpened() and roi_out.isOpened() and mask_out.isOpened()):
-            st.error("Error: Could not initialize video writers.")
-            cap.release()
-            os.unlink(video_path)
-            st.stop()
-
-        # Progress bar and status
-        st.write("### Processing Video")
-        progress_bar = st.progress(0)
-        status_text = st.empty()
-        processed_frames = 0
-
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-
-            # Extract Region of Interest
-            roi = frame[roi_y_start:roi_y_end, roi_x_start:roi_x_end]
-
-            # Object Detection
-            mask = object_detector.apply(roi)
-            _, mask = cv2.threshold(mask, 254, 255, cv2.THRESH_BINARY)
-            contours, _ = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-            detections = []
-            for cnt in contours:
-                area = cv2.contourArea(cnt)
-                if area > 100:
-                    x, y, w, h = cv2.boundingRect(cnt)
-                    detections.append([x, y, w, h])
-
-            # Object Tracking
-            boxes_ids = tracker.update(detections)
-            for box_id in boxes_ids:
-                x, y, w, h, id = box_id
-                cv2.putText(roi, str(id), (x, y - 15), cv2.FONT_HERSHEY_PLAIN, 2, (255, 0, 0), 2)
-                cv2.rectangle(roi, (x, y), (x + w, y + h), (0, 255, 0), 3)
-
-            # Write frames to output videos
-            tracked_out.write(frame)
-            roi_out.write(roi)
-            mask_out.write(mask)
-
-            # Update progress
-            processed_frames += 1
-            progress = min(processed_frames / frame_count, 1.0)
-            progress_bar.progress(progress)
-            status_text.text(f"Processing frame {processed_frames}/{frame_count} ({int(progress*100)}%)")
-
-        # Release resources
-        cap.release()
-        tracked_out.release()
-        roi_out.release()
-        mask_out.release()
-
-        # Verify output files
-        for output_file in [tracked_output_file, roi_output_file, mask_output_file]:
-            if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
-                st.error(f"Error: Output video {output_file} was not created successfully.")
-                os.unlink(video_path)
-                for f in [tracked_output_file, roi_output_file, mask_output_file]:
-                    if os.path.exists(f):
-                        os.unlink(f)
-                st.stop()
-
-        # Convert videos to base64
-        tracked_b64 = video_to_base64(tracked_output_file)
-        roi_b64 = video_to_base64(roi_output_file)
-        mask_b64 = video_to_base64(mask_output_file)
+        # getvalue() returns the upload's own buffer, so this does not copy the video
+        video_bytes = uploaded_file.getvalue()
+        roi_box = (roi_x_start, roi_y_start, roi_x_end, roi_y_end)
+        output_files = process_video(video_bytes, roi_box, detection_scale)
+        if all(os.path.exists(f) for f in output_files):
+            # Mark the outputs as recently used so that pruning keeps them
+            os.utime(os.path.dirname(output_files[0]))
+        else:
+            # The cached outputs were pruned from disk, drop this entry and process the video again
+            process_video.clear(video_bytes, roi_box, detection_scale)
+            output_files = process_video(video_bytes, roi_box, detection_scale)
+        tracked_output_file, roi_output_file, mask_output_file = output_files
 
         # Display results
         st.success("Processing complete!")
         st.write("### Tracked Video")
-        html(f"""
-            <div class="video-container">
-                <video width="100%" controls autoplay muted>
-                    <source src="data:video/mp4;base64,{tracked_b64}" type="video/mp4">
-                    Your browser does not support the video tag.
-                </video>
-            </div>
-        """, height=height//2)
+        st.video(tracked_output_file, autoplay=True, muted=True)
 
         st.write("### ROI and Mask Videos")
         col1, col2 = st.columns(2)
         with col1:
             st.write("**ROI Video**")
-            html(f"""
-                <div class="video-container">
-                    <video width="100%" controls autoplay muted>
-                        <source src="data:video/mp4;base64,{roi_b64}" type="video/mp4">
-                        Your browser does not support the video tag.
-                    </video>
-                </div>
-            """, height=(roi_y_end - roi_y_start)//2)
+            st.video(roi_output_file, autoplay=True, muted=True)
         with col2:
             st.write("**Mask Video**")
-            html(f"""
-                <div class="video-container">
-                    <video width="100%" controls autoplay muted>
-                        <source src="data:video/mp4;base64,{mask_b64}" type="video/mp4">
-                        Your browser does not support the video tag.
-                    </video>
-                </div>
-            """, height=(roi_y_end - roi_y_start)//2)
-
-        # Clean up temporary files
-        os.unlink(video_path)
-        os.unlink(tracked_output_file)
-        os.unlink(roi_output_file)
-        os.unlink(mask_output_file)
-
+            # Browsers cannot play FFV1, so an H.264 preview is only encoded, and the lossless
+            # file only read for download, when the user asks for them
+            if st.toggle("Show Mask Preview"):
+                with st.spinner("Encoding mask preview..."):
+                    st.video(mask_preview(mask_output_file), autoplay=True, muted=True)
+            if st.toggle("Download Lossless Mask (FFV1)"):
+                with open(mask_output_file, "rb") as mask_file:
+                    st.download_button("Download Mask Video", mask_file, file_name="mask.mkv", mime="video/x-matroska")
+
+    except VideoProcessingError as e:
+        st.error(str(e))
     except Exception as e:
         st.error(f"An error occurred: {str(e)}")
-        if 'cap' in locals():
-            cap.release()
-        for out in ['tracked_out', 'roi_out', 'mask_out']:
-            if out in locals():
-                locals()[out].release()
-        for f in ['video_path', 'tracked_output_file', 'roi_output_file', 'mask_output_file']:
-            if f in locals() and os.path.exists(locals()[f]):
-                os.unlink(locals()[f])
 
 else:
     st.info("Please upload a video file to start tracking. Supported formats: MP4, AVI, MOV.")
@@ -0,0 +1,68 @@
+import cv2
+import numpy as np
+
+
+def cuda_available():
+    # pip builds of OpenCV ship the cv2.cuda module without any CUDA devices
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except (AttributeError, cv2.error):
+        return False
+
+
+def opencl_available():
+    return cv2.ocl.haveOpenCL() and cv2.ocl.useOpenCL()
+
+
+class ForegroundDetector:
+    def __init__(self, history=100, var_threshold=40):
+        # Run MOG2 on the GPU when OpenCV was built with CUDA, otherwise through
+        # OpenCL (UMat) when a device is available, otherwise on the CPU
+        self.use_cuda = cuda_available()
+        self.use_opencl = not self.use_cuda and opencl_available()
+        # A 3x3 opening removes speckle noise from the mask in a single filter call
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+        if self.use_cuda:
+            self.subtractor = cv2.cuda.createBackgroundSubtractorMOG2(history=history, varThreshold=var_threshold,
+                                                                      detectShadows=True)
+            # Device buffers are reused across frames to avoid per-frame allocations
+            self.gpu_roi = cv2.cuda_GpuMat()
+            self.gpu_mask = cv2.cuda_GpuMat()
+            self.gpu_binary = cv2.cuda_GpuMat()
+            self.gpu_opened = cv2.cuda_GpuMat()
+            self.stream = cv2.cuda.Stream_Null()
+            self.open_filter = cv2.cuda.createMorphologyFilter(cv2.MORPH_OPEN, cv2.CV_8UC1, self.kernel)
+        else:
+            self.subtractor = cv2.createBackgroundSubtractorMOG2(history=history, varThreshold=var_threshold,
+                                                                 detectShadows=True)
+            if self.use_opencl:
+                # Device buffers are allocated on the first frame and reused after that
+                self.umat_mask = cv2.UMat()
+                self.umat_opened = cv2.UMat()
+
+    def apply(self, roi, mask=None):
+        # Return a binary foreground mask with speckle noise opened away. MOG2 marks
+        # shadows as 127, keeping only values above 254 drops them from the foreground.
+        # When a preallocated mask is given the result is written into it
+        if self.use_cuda:
+            self.gpu_roi.upload(roi)
+            self.gpu_mask = self.subtractor.apply(self.gpu_roi, -1, self.stream, self.gpu_mask)
+            _, self.gpu_binary = cv2.cuda.threshold(self.gpu_mask, 254, 255, cv2.THRESH_BINARY, self.gpu_binary,
+                                                    self.stream)
+            self.gpu_opened = self.open_filter.apply(self.gpu_binary, self.gpu_opened)
+            return self.gpu_opened.download(mask)
+
+        if self.use_opencl:
+            self.umat_mask = self.subtractor.apply(cv2.UMat(roi), self.umat_mask, learningRate=-1)
+            self.umat_mask = cv2.compare(self.umat_mask, 254, cv2.CMP_GT, dst=self.umat_mask)
+            self.umat_opened = cv2.morphologyEx(self.umat_mask, cv2.MORPH_OPEN, self.kernel, dst=self.umat_opened)
+            # UMat.get() cannot download into an existing array, so the host copy goes through one temporary
+            result = self.umat_opened.get()
+            if mask is None:
+                return result
+            np.copyto(mask, result)
+            return mask
+
+        mask = self.subtractor.apply(roi, mask, learningRate=-1)
+        cv2.compare(mask, 254, cv2.CMP_GT, dst=mask)
+        return cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.kernel, dst=mask)
@@ -0,0 +1,502 @@
+import concurrent.futures
+import math
+import multiprocessing
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+
+import cv2
+import numpy as np
+
+from detector import ForegroundDetector
+from tracker import EuclideanDistTracker
+from video_writer import (AUTO_ENCODER, MAX_HW_SESSIONS, choose_encoder, open_lossless_writer, open_video_writer,
+                          set_hw_session_limit)
+
+
+# OpenCV splits parallel_for_ work into stripes based on the thread count, so asking
+# for several threads per core gives finer stripes that balance better on uneven work.
+# Applied to the Streamlit process and, for their share of the cores, to the chunk workers
+OPENCV_THREADS_PER_CORE = 3
+# Sentinel pushed through the pipeline queues to signal end of stream
+SENTINEL = None
+# Number of frames buffered between pipeline stages
+QUEUE_SIZE = 8
+# Minimum blob area, in full-resolution ROI pixels, counted as an object
+MIN_OBJECT_AREA = 100
+# Initial capacity of the per-frame detections buffer, grown when a frame has more blobs
+MAX_DETECTIONS = 256
+# Once the background model has seen MOG2_HISTORY frames, frames whose detection-resolution
+# ROI differs from the last processed one by more than MOTION_PIXEL_DIFF in fewer pixels than
+# one edge of the smallest object skip detection and tracking
+MOTION_PIXEL_DIFF = 10
+# MOG2 history length, also the number of frames each parallel chunk uses to warm up its model
+MOG2_HISTORY = 100
+# Videos are split into chunks of at least this many frames (about five minutes), one per worker
+# process. Spawning workers, warming up each chunk and joining the outputs only pays off on long
+# videos, and each chunk boundary starts a new range of track IDs
+MIN_CHUNK_FRAMES = 9000
+# Track IDs of chunk i start at i * CHUNK_ID_STRIDE so IDs from different chunks never collide
+CHUNK_ID_STRIDE = 100000
+
+
+# Raised for problems with the uploaded video or ROI that are shown to the user as-is
+class VideoProcessingError(Exception):
+    pass
+
+
+# Reader stage: decode frames from the capture and push them to the read queue.
+# cancel_event is an optional event shared across processes that ends the stream early
+def read_frames(cap, read_q, stop_event, max_frames=None, cancel_event=None):
+    idx = 0
+    while (not stop_event.is_set() and (cancel_event is None or not cancel_event.is_set())
+           and (max_frames is None or idx < max_frames)):
+        ret, frame = cap.read()
+        if not ret:
+            break
+        read_q.put((idx, frame))
+        idx += 1
+    read_q.put(SENTINEL)
+
+
+# Writer stage: pop processed frames from the write queue and encode them.
+# On an encoder failure the error is recorded and the queue keeps draining so the main thread never blocks.
+def write_frames(write_q, tracked_out, roi_out, mask_out, errors):
+    while True:
+        item = write_q.get()
+        if item is SENTINEL:
+            break
+        if errors:
+            continue
+        frame, roi, mask = item
+        try:
+            tracked_out.write(frame)
+            roi_out.write(roi)
+            mask_out.write(mask)
+        except Exception as e:
+            errors.append(e)
+
+
+class FrameProcessor:
+    # Per-frame detection, tracking and annotation for one video segment.
+    # process() returns the clean ROI and the mask of a frame and draws the tracked boxes on
+    # the frame itself. Clean ROIs and masks are queued for the writer, so they rotate through
+    # ring_size buffers (more than the writer can hold) instead of being allocated per frame
+    def __init__(self, roi_box, detection_scale, object_detector, tracker, ring_size,
+                 min_object_area, max_detections, gate_pixel_diff, gate_warmup):
+        self.roi_x_start, self.roi_y_start, self.roi_x_end, self.roi_y_end = roi_box
+        self.roi_w = self.roi_x_end - self.roi_x_start
+        self.roi_h = self.roi_y_end - self.roi_y_start
+        self.detection_scale = detection_scale
+        self.object_detector = object_detector
+        self.tracker = tracker
+        self.gate_pixel_diff = gate_pixel_diff
+        self.gate_warmup = gate_warmup
+
+        self.roi_bufs = [np.empty((self.roi_h, self.roi_w, 3), dtype=np.uint8) for _ in range(ring_size)]
+        self.mask_bufs = [np.empty((self.roi_h, self.roi_w), dtype=np.uint8) for _ in range(ring_size)]
+        # Detection runs on the ROI downscaled by detection_scale; boxes are scaled back up
+        self.det_w = max(1, self.roi_w // detection_scale)
+        self.det_h = max(1, self.roi_h // detection_scale)
+        self.min_area = min_object_area / (detection_scale * detection_scale)
+        self.small_roi_buf = np.empty((self.det_h, self.det_w, 3), dtype=np.uint8)
+        self.small_mask_buf = np.empty((self.det_h, self.det_w), dtype=np.uint8)
+        self.labels_buf = np.empty((self.det_h, self.det_w), dtype=np.int32)
+        self.det_buf = np.empty((max_detections, 4), dtype=np.int32)
+        # An object of min_area pixels moving by one pixel changes at least about one of its edges
+        self.gate_min_pixels = max(1, int(math.sqrt(self.min_area)))
+        # Grayscale detection-resolution ROIs of the current and the last processed frame
+        self.gray_bufs = [np.empty((self.det_h, self.det_w), dtype=np.uint8) for _ in range(2)]
+        self.diff_buf = np.empty((self.det_h, self.det_w), dtype=np.uint8)
+
+        self.frame_index = 0
+        # Frames fed to the background model so far; until it has seen its history, its
+        # mask is not trusted for reuse on static frames
+        self.model_frames = 0
+        self.gray_index = 0
+        self.prev_gray = None
+        self.last_mask = None
+        self.boxes_ids = None
+
+    def _snapshot_roi(self, frame):
+        # Copy the ROI into a contiguous buffer before annotations are drawn on the frame
+        clean_roi = self.roi_bufs[self.frame_index % len(self.roi_bufs)]
+        np.copyto(clean_roi, frame[self.roi_y_start:self.roi_y_end, self.roi_x_start:self.roi_x_end])
+        return clean_roi
+
+    def _downscale(self, clean_roi):
+        # Return the ROI at detection resolution
+        if self.detection_scale == 1:
+            return clean_roi
+        return cv2.resize(clean_roi, (self.det_w, self.det_h), dst=self.small_roi_buf, interpolation=cv2.INTER_AREA)
+
+    def _detect(self, small_roi, mask):
+        # Run the background model and return the mask at detection resolution
+        self.model_frames += 1
+        if self.detection_scale == 1:
+            return self.object_detector.apply(small_roi, mask)
+        return self.object_detector.apply(small_roi, self.small_mask_buf)
+
+    def warm_up(self, frame):
+        # Feed a frame to the background model only
+        self._detect(self._downscale(self._snapshot_roi(frame)), self.mask_bufs[self.frame_index % len(self.mask_bufs)])
+
+    def process(self, frame):
+        clean_roi = self._snapshot_roi(frame)
+        mask = self.mask_bufs[self.frame_index % len(self.mask_bufs)]
+        self.frame_index += 1
+        small_roi = self._downscale(clean_roi)
+
+        # Motion gate: compare the grayscale detection-resolution ROI against the last fully processed frame
+        cur_gray = cv2.cvtColor(small_roi, cv2.COLOR_BGR2GRAY, dst=self.gray_bufs[self.gray_index])
+        static = False
+        if self.prev_gray is not None and self.model_frames >= self.gate_warmup:
+            cv2.absdiff(cur_gray, self.prev_gray, dst=self.diff_buf)
+            static = np.count_nonzero(self.diff_buf > self.gate_pixel_diff) < self.gate_min_pixels
+
+        if static:
+            # Nothing moved: reuse the previous mask and boxes without running detection
+            np.copyto(mask, self.last_mask)
+        else:
+            # Object Detection
+            det_mask = self._detect(small_roi, mask)
+            if self.detection_scale != 1:
+                cv2.resize(det_mask, (self.roi_w, self.roi_h), dst=mask, interpolation=cv2.INTER_NEAREST)
+            # Label connected blobs and filter them by area in one pass (label 0 is background)
+            _, _, stats, _ = cv2.connectedComponentsWithStats(det_mask, labels=self.labels_buf, connectivity=8)
+            keep = stats[1:, cv2.CC_STAT_AREA] > self.min_area
+            n_det = np.count_nonzero(keep)
+            if n_det > len(self.det_buf):
+                self.det_buf = np.empty((n_det, 4), dtype=np.int32)
+            # Columns 0-3 of stats are LEFT, TOP, WIDTH, HEIGHT
+            det_arr = np.compress(keep, stats[1:, :4], axis=0, out=self.det_buf[:n_det])
+            det_arr *= self.detection_scale
+
+            # Object Tracking
+            self.boxes_ids = self.tracker.update_fast(det_arr)
+            # Keep this frame as the gate reference and write the next one into the other buffer
+            self.prev_gray = cur_gray
+            self.gray_index = 1 - self.gray_index
+        self.last_mask = mask
+
+        for box_id in self.boxes_ids.tolist():
+            x, y, w, h, id = box_id
+            x += self.roi_x_start
+            y += self.roi_y_start
+            cv2.putText(frame, str(id), (x, y - 15), cv2.FONT_HERSHEY_PLAIN, 2, (255, 0, 0), 2)
+            cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 3)
+
+        return clean_roi, mask
+
+
+def read_video_info(video_path):
+    # Return (width, height, fps, frame_count) of a video file
+    cap = cv2.VideoCapture(video_path)
+    try:
+        if not cap.isOpened():
+            raise VideoProcessingError("Error: Could not open video file.")
+        return (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                int(cap.get(cv2.CAP_PROP_FPS)), int(cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+    finally:
+        cap.release()
+
+
+def seek_frame(cap, video_path, frame_index):
+    # Position a capture on frame_index and return it. Container seeks can land a few frames
+    # off, so when the reported position is wrong the video is reopened and decoded forward
+    if frame_index <= 0:
+        return cap
+    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+    if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) == frame_index:
+        return cap
+    cap.release()
+    cap = cv2.VideoCapture(video_path)
+    for _ in range(frame_index):
+        if not cap.grab():
+            break
+    return cap
+
+
+def process_segment(video_path, output_files, roi_box, detection_scale,
+                    start=0, end=None, warmup=0, first_id=0, encoders=(AUTO_ENCODER, AUTO_ENCODER), progress=None,
+                    cancel_event=None):
+    # Track objects in frames [start, end) of a video and write the tracked, ROI and lossless
+    # mask videos. The background model is first warmed up on the `warmup` frames before start.
+    # encoders selects the H.264 encoder of the tracked and ROI videos, see open_video_writer.
+    # progress(n) is called with the number of frames finished since the previous call, and
+    # setting cancel_event stops reading so the segment ends after the frames already queued
+    roi_x_start, roi_y_start, roi_x_end, roi_y_end = roi_box
+    tracked_output_file, roi_output_file, mask_output_file = output_files
+
+    cap = cv2.VideoCapture(video_path)
+    writers = []
+    try:
+        if not cap.isOpened():
+            raise VideoProcessingError("Error: Could not open video file.")
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        fps = int(cap.get(cv2.CAP_PROP_FPS))
+        cap = seek_frame(cap, video_path, start - warmup)
+        max_frames = None if end is None else end - start + warmup
+
+        roi_w = roi_x_end - roi_x_start
+        roi_h = roi_y_end - roi_y_start
+
+        # Initialize tracker and detector
+        tracker = EuclideanDistTracker()
+        tracker.id_count = first_id
+        object_detector = ForegroundDetector(history=MOG2_HISTORY, var_threshold=40)
+
+        # Use a hardware H.264 encoder when one is available; the binary mask is stored losslessly
+        tracked_out = open_video_writer(tracked_output_file, fps, (width, height), encoder=encoders[0])
+        roi_out = open_video_writer(roi_output_file, fps, (roi_w, roi_h), encoder=encoders[1])
+        mask_out = open_lossless_writer(mask_output_file, fps, (roi_w, roi_h), is_color=False)
+        writers = [tracked_out, roi_out, mask_out]
+
+        if not all(writer.isOpened() for writer in writers):
+            raise VideoProcessingError("Error: Could not initialize video writers.")
+
+        processed_frames = 0
+        reported_frames = 0
+        segment_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) - start if end is None else end - start
+        progress_interval = max(1, segment_frames // 100)
+
+        processor = FrameProcessor(roi_box, detection_scale, object_detector, tracker,
+                                   QUEUE_SIZE + 2, MIN_OBJECT_AREA, MAX_DETECTIONS,
+                                   MOTION_PIXEL_DIFF, MOG2_HISTORY)
+
+        # Decode and encode run on their own threads; detection and tracking
+        # stay on the main thread so the tracker needs no locking
+        read_q = queue.Queue(maxsize=QUEUE_SIZE)
+        write_q = queue.Queue(maxsize=QUEUE_SIZE)
+        stop_event = threading.Event()
+        write_errors = []
+        reader_thread = threading.Thread(target=read_frames, args=(cap, read_q, stop_event, max_frames, cancel_event),
+                                         daemon=True)
+        writer_thread = threading.Thread(target=write_frames, args=(write_q, tracked_out, roi_out, mask_out, write_errors), daemon=True)
+        reader_thread.start()
+        writer_thread.start()
+
+        try:
+            while True:
+                item = read_q.get()
+                if item is SENTINEL:
+                    break
+                idx, frame = item
+
+                if idx < warmup:
+                    # Warm up the background model on frames before this segment; nothing is written
+                    processor.warm_up(frame)
+                    continue
+
+                clean_roi, mask = processor.process(frame)
+
+                # Hand frames to the writer thread
+                write_q.put((frame, clean_roi, mask))
+
+                # Report progress about every 1% to limit round-trips to the browser
+                processed_frames += 1
+                if progress is not None and processed_frames % progress_interval == 0:
+                    progress(processed_frames - reported_frames)
+                    reported_frames = processed_frames
+        finally:
+            # Stop the reader, drain its queue so it can exit, and flush the writer
+            stop_event.set()
+            while reader_thread.is_alive():
+                try:
+                    read_q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            reader_thread.join()
+            write_q.put(SENTINEL)
+            writer_thread.join()
+        if write_errors:
+            raise write_errors[0]
+        if progress is not None and processed_frames > reported_frames:
+            progress(processed_frames - reported_frames)
+    finally:
+        # Release resources so the output files are complete; an encoder that exited with an
+        # error is reported once every writer has been closed
+        cap.release()
+        release_errors = []
+        for writer in writers:
+            try:
+                writer.release()
+            except RuntimeError as e:
+                release_errors.append(e)
+        if release_errors:
+            raise release_errors[0]
+
+
+# Shared frame counter and cancel event of the worker processes, set by _init_worker
+_worker_progress = None
+_worker_cancel = None
+
+
+def _init_worker(progress_counter, cancel_event, opencv_threads):
+    global _worker_progress, _worker_cancel
+    _worker_progress = progress_counter
+    _worker_cancel = cancel_event
+    # Workers already run in parallel, so each one only gets threads for its share of the cores
+    cv2.setNumThreads(opencv_threads)
+
+
+def _report_worker_progress(n):
+    with _worker_progress.get_lock():
+        _worker_progress.value += n
+
+
+def _process_chunk(hw_sessions, *args, **kwargs):
+    # Each chunk only opens its share of the machine's hardware encoder sessions
+    set_hw_session_limit(hw_sessions)
+    process_segment(*args, progress=_report_worker_progress, cancel_event=_worker_cancel, **kwargs)
+
+
+def choose_chunk_encoders(sizes, n_chunks):
+    # Chunks of an output are joined by stream copy, so every chunk must encode it the same way.
+    # Each output gets the hardware encoder only if all chunks can open a session for it at once;
+    # the others use software encoding in every chunk
+    budget = MAX_HW_SESSIONS // n_chunks
+    encoders = []
+    for size in sizes:
+        encoder = choose_encoder(size) if budget > 0 else None
+        budget -= encoder is not None
+        encoders.append(encoder)
+    return encoders
+
+
+def mask_preview(mask_file):
+    # Return the path of a browser-playable H.264 copy of a lossless mask video, encoding it
+    # next to the mask on first use. The copy is written under a temporary name and moved
+    # into place, so concurrent callers never see a partial file
+    preview_file = os.path.splitext(mask_file)[0] + "_preview.mp4"
+    if os.path.exists(preview_file):
+        return preview_file
+    cap = cv2.VideoCapture(mask_file, cv2.CAP_FFMPEG)
+    fd, tmp_file = tempfile.mkstemp(suffix=".mp4", dir=os.path.dirname(mask_file))
+    os.close(fd)
+    writer = None
+    try:
+        if not cap.isOpened():
+            raise VideoProcessingError("Error: Could not open mask video.")
+        size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        writer = open_video_writer(tmp_file, int(cap.get(cv2.CAP_PROP_FPS)), size, is_color=False)
+        if not writer.isOpened():
+            raise VideoProcessingError("Error: Could not initialize video writers.")
+        # The decoder returns the gray mask as BGR
+        gray = np.empty((size[1], size[0]), dtype=np.uint8)
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            writer.write(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray))
+        writer.release()
+        writer = None
+        os.replace(tmp_file, preview_file)
+    finally:
+        cap.release()
+        if writer is not None:
+            writer.release()
+        if os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+    return preview_file
+
+
+def concat_videos(chunk_files, output_file):
+    # Join chunk videos with ffmpeg's concat demuxer, without re-encoding
+    list_file = output_file + ".txt"
+    with open(list_file, "w") as f:
+        for chunk_file in chunk_files:
+            f.write(f"file '{chunk_file}'\n")
+    cmd = [shutil.which("ffmpeg"), "-hide_banner", "-loglevel", "error",
+           "-f", "concat", "-safe", "0", "-i", list_file, "-c", "copy"]
+    if output_file.endswith(".mp4"):
+        cmd += ["-movflags", "+faststart"]
+    try:
+        result = subprocess.run(cmd + ["-y", output_file], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    finally:
+        os.unlink(list_file)
+    if result.returncode != 0:
+        raise VideoProcessingError(f"Error: Could not join video chunks: {result.stderr.decode(errors='replace').strip()}")
+
+
+def process_video_file(video_path, output_files, roi_box, detection_scale, progress=None):
+    # Track objects in a whole video. Long videos are split into chunks processed in
+    # parallel worker processes and joined with ffmpeg; each chunk warms up its background
+    # model on the frames before it, and tracks crossing a chunk boundary get a new ID.
+    # progress(done, total) is called with the number of finished frames
+    roi_x_start, roi_y_start, roi_x_end, roi_y_end = roi_box
+    width, height, _, frame_count = read_video_info(video_path)
+
+    # Validate ROI
+    if roi_y_end <= roi_y_start or roi_x_end <= roi_x_start:
+        raise VideoProcessingError("Invalid ROI: End coordinates must be greater than start coordinates.")
+    if roi_y_end > height or roi_x_end > width:
+        raise VideoProcessingError(f"ROI exceeds video dimensions (width: {width}, height: {height}).")
+
+    cores = os.cpu_count() or 1
+    n_chunks = min(cores, frame_count // MIN_CHUNK_FRAMES)
+    if n_chunks < 2 or shutil.which("ffmpeg") is None:
+        done = 0
+
+        def report(n):
+            nonlocal done
+            done += n
+            if progress is not None:
+                progress(done, frame_count)
+
+        process_segment(video_path, output_files, roi_box, detection_scale, progress=report)
+    else:
+        chunk_dir = tempfile.mkdtemp(dir=os.path.dirname(output_files[0]))
+        try:
+            # The frame count from the container is only an estimate, so the last chunk reads to the end
+            bounds = [frame_count * i // n_chunks for i in range(n_chunks)] + [None]
+            chunk_files = [[os.path.join(chunk_dir, f"{i}_{os.path.basename(f)}") for f in output_files]
+                           for i in range(n_chunks)]
+
+            encoders = choose_chunk_encoders([(width, height), (roi_x_end - roi_x_start, roi_y_end - roi_y_start)],
+                                             n_chunks)
+            hw_sessions = sum(encoder is not None for encoder in encoders)
+
+            # Spawn rather than fork, the parent process runs Streamlit's threads
+            ctx = multiprocessing.get_context("spawn")
+            counter = ctx.Value("q", 0)
+            cancel_event = ctx.Event()
+            worker_threads = OPENCV_THREADS_PER_CORE * max(1, cores // n_chunks)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=n_chunks, mp_context=ctx, initializer=_init_worker,
+                                                        initargs=(counter, cancel_event, worker_threads)) as executor:
+                futures = [executor.submit(_process_chunk, hw_sessions, video_path, chunk_files[i], roi_box,
+                                           detection_scale, start=bounds[i], end=bounds[i + 1],
+                                           warmup=min(MOG2_HISTORY, bounds[i]), first_id=i * CHUNK_ID_STRIDE,
+                                           encoders=encoders)
+                           for i in range(n_chunks)]
+                pending = set(futures)
+                try:
+                    while pending:
+                        done, pending = concurrent.futures.wait(pending, timeout=0.5,
+                                                                return_when=concurrent.futures.FIRST_EXCEPTION)
+                        # Raise the first chunk error as soon as it happens
+                        for future in done:
+                            future.result()
+                        if progress is not None:
+                            progress(counter.value, frame_count)
+                except BaseException:
+                    # A failed chunk, or Streamlit's rerun/stop exception raised from progress():
+                    # stop the running chunks so leaving the executor does not wait for them to finish
+                    cancel_event.set()
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+            for i, output_file in enumerate(output_files):
+                concat_videos([files[i] for files in chunk_files], output_file)
+        finally:
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+
+    # Verify output files
+    for output_file in output_files:
+        if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
+            raise VideoProcessingError(f"Error: Output video {output_file} was not created successfully.")
@@ -1,53 +1,105 @@
-import math
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    # Numba is optional, the kernel below also runs as plain Python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+@njit(cache=True, fastmath=True)
+def _assign(det_cx, det_cy, tr_cx, tr_cy, n_tracks, thresh):
+    # Match each detection to the first track closer than thresh, in track order.
+    # Matched tracks move to the detection, unmatched detections become new tracks
+    # appended after the existing ones. Returns the track slot of every detection
+    # and the new number of tracks.
+    n_det = det_cx.shape[0]
+    assign = np.empty(n_det, np.int64)
+    thresh_sq = thresh * thresh
+    for i in range(n_det):
+        cx = det_cx[i]
+        cy = det_cy[i]
+        slot = -1
+        for j in range(n_tracks):
+            dx = cx - tr_cx[j]
+            dy = cy - tr_cy[j]
+            if dx * dx + dy * dy < thresh_sq:
+                slot = j
+                break
+        if slot == -1:
+            slot = n_tracks
+            n_tracks += 1
+        tr_cx[slot] = cx
+        tr_cy[slot] = cy
+        assign[i] = slot
+    return assign, n_tracks
 
 
 class EuclideanDistTracker:
-    def __init__(self):
-        # Store the center positions of the objects
-        self.center_points = {}
+    def __init__(self, capacity=256):
+        # Store the center positions of the objects as structure-of-arrays,
+        # the first n_tracks slots are live and kept in the order they were last seen
+        self.cx = np.empty(capacity, np.float32)
+        self.cy = np.empty(capacity, np.float32)
+        self.ids = np.empty(capacity, np.int64)
+        self.n_tracks = 0
         # Keep the count of the IDs
         # each time a new object id detected, the count will increase by one
         self.id_count = 0
 
+    @property
+    def center_points(self):
+        return {int(i): (int(x), int(y)) for i, x, y in
+                zip(self.ids[:self.n_tracks], self.cx[:self.n_tracks], self.cy[:self.n_tracks])}
 
-    def update(self, objects_rect):
-        # Objects boxes and ids
-        objects_bbs_ids = []
-
-        # Get center point of new object
-        for rect in objects_rect:
-            x, y, w, h = rect
-            cx = (x + x + w) // 2
-            cy = (y + y + h) // 2
-
-            # Find out if that object was detected already
-            same_object_detected = False
-            for id, pt in self.center_points.items():
-                dist = math.hypot(cx - pt[0], cy - pt[1])
-
-                if dist < 25:
-                    self.center_points[id] = (cx, cy)
-                    print(self.center_points)
-                    objects_bbs_ids.append([x, y, w, h, id])
-                    same_object_detected = True
-                    break
-
-            # New object is detected we assign the ID to that object
-            if same_object_detected is False:
-                self.center_points[self.id_count] = (cx, cy)
-                objects_bbs_ids.append([x, y, w, h, self.id_count])
-                self.id_count += 1
-
-        # Clean the dictionary by center points to remove IDS not used anymore
-        new_center_points = {}
-        for obj_bb_id in objects_bbs_ids:
-            _, _, _, _, object_id = obj_bb_id
-            center = self.center_points[object_id]
-            new_center_points[object_id] = center
-
-        # Update dictionary with IDs not used removed
-        self.center_points = new_center_points.copy()
-        return objects_bbs_ids
+    def _reserve(self, size):
+        # Grow the track arrays so that they hold at least size entries
+        capacity = self.cx.shape[0]
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity)
+        for name in ("cx", "cy", "ids"):
+            old = getattr(self, name)
+            new = np.empty(capacity, old.dtype)
+            new[:self.n_tracks] = old[:self.n_tracks]
+            setattr(self, name, new)
+
+    def update_fast(self, det_arr):
+        # det_arr is an (N, 4) int array of x, y, w, h boxes.
+        # Returns an (N, 5) int array of x, y, w, h, id
+        det_arr = np.asarray(det_arr, dtype=np.int32).reshape(-1, 4)
+        n_det = det_arr.shape[0]
 
+        # Get center point of new objects
+        det_cx = ((2 * det_arr[:, 0] + det_arr[:, 2]) // 2).astype(np.float32)
+        det_cy = ((2 * det_arr[:, 1] + det_arr[:, 3]) // 2).astype(np.float32)
 
+        # Every unmatched detection may open a new track
+        self._reserve(self.n_tracks + n_det)
+        old_n = self.n_tracks
+        assign, n_tracks = _assign(det_cx, det_cy, self.cx, self.cy, old_n, np.float32(25))
 
+        # New objects are detected, we assign IDs to them
+        n_new = n_tracks - old_n
+        self.ids[old_n:n_tracks] = np.arange(self.id_count, self.id_count + n_new)
+        self.id_count += n_new
+
+        objects_bbs_ids = np.empty((n_det, 5), np.int64)
+        objects_bbs_ids[:, :4] = det_arr
+        objects_bbs_ids[:, 4] = self.ids[assign]
+
+        # Keep only the tracks seen in this frame, ordered by their first detection
+        _, first = np.unique(assign, return_index=True)
+        keep = assign[np.sort(first)]
+        self.n_tracks = keep.shape[0]
+        self.cx[:self.n_tracks] = self.cx[keep]
+        self.cy[:self.n_tracks] = self.cy[keep]
+        self.ids[:self.n_tracks] = self.ids[keep]
+        return objects_bbs_ids
+
+    def update(self, objects_rect):
+        # List-based interface, returns a list of [x, y, w, h, id]
+        return self.update_fast(objects_rect).tolist()
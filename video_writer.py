@@ -0,0 +1,207 @@
+import functools
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+import cv2
+import numpy as np
+
+
+# Hardware H.264 encoders to try, in order of preference, with their fastest presets
+HW_ENCODERS = {
+    "h264_nvenc": ["-preset", "p1"],
+    "h264_videotoolbox": ["-realtime", "1"],
+    "h264_qsv": ["-preset", "veryfast"],
+}
+# Encoder argument of open_video_writer that picks a hardware encoder when one works
+AUTO_ENCODER = "auto"
+# H.264 with 4:2:0 chroma needs even dimensions
+PAD_EVEN = "pad=ceil(iw/2)*2:ceil(ih/2)*2"
+# Consumer GPUs limit how many encode sessions can be open at once, so each process opens at
+# most this many hardware writers and falls back to software encoding for the rest. The
+# parallel chunk workers split the budget between them with set_hw_session_limit
+MAX_HW_SESSIONS = 3
+
+_hw_lock = threading.Lock()
+_hw_limit = MAX_HW_SESSIONS
+_hw_active = 0
+
+
+def set_hw_session_limit(limit):
+    global _hw_limit
+    with _hw_lock:
+        _hw_limit = limit
+
+
+def _acquire_hw_session():
+    global _hw_active
+    with _hw_lock:
+        if _hw_active >= _hw_limit:
+            return False
+        _hw_active += 1
+        return True
+
+
+def _release_hw_session():
+    global _hw_active
+    with _hw_lock:
+        _hw_active -= 1
+
+
+@functools.lru_cache(maxsize=None)
+def encoder_works(encoder, width=64, height=64, pix_fmt="bgr24"):
+    # Encode a single frame of the given size and pixel format to check that the encoder
+    # and its device accept it; size limits and missing devices only show up here
+    probe = [shutil.which("ffmpeg"), "-hide_banner", "-loglevel", "error",
+             "-f", "lavfi", "-i", f"color=size={width}x{height},format={pix_fmt}", "-frames:v", "1",
+             "-vf", PAD_EVEN, "-c:v", encoder, *HW_ENCODERS[encoder], "-f", "null", "-"]
+    try:
+        result = subprocess.run(probe, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return result.returncode == 0
+
+
+@functools.lru_cache(maxsize=None)
+def detect_hw_encoder():
+    # Return the first hardware encoder that ffmpeg can actually open, or None
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        return None
+
+    if sys.platform == "darwin":
+        candidates = ["h264_videotoolbox"]
+    else:
+        candidates = ["h264_nvenc", "h264_qsv"]
+
+    for encoder in candidates:
+        if encoder_works(encoder):
+            return encoder
+    return None
+
+
+class FFmpegWriter:
+    # Minimal cv2.VideoWriter look-alike that pipes raw frames to an ffmpeg hardware encoder.
+    # It holds one hardware session until released and is not opened when none is free.
+    # Encoder failures are raised as RuntimeError with ffmpeg's error output
+    def __init__(self, path, encoder, fps, size, is_color=True):
+        width, height = size
+        pix_fmt = "bgr24" if is_color else "gray"
+        self.encoder = encoder
+        self.proc = None
+        self.stderr = None
+        self.has_session = _acquire_hw_session()
+        if not self.has_session:
+            return
+        cmd = [shutil.which("ffmpeg"), "-hide_banner", "-loglevel", "error",
+               "-f", "rawvideo", "-pix_fmt", pix_fmt, "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+               "-vf", PAD_EVEN, "-c:v", encoder, *HW_ENCODERS[encoder],
+               "-movflags", "+faststart", "-y", path]
+        # ffmpeg's errors go to a file rather than a pipe, which could fill up while nobody reads it
+        self.stderr = tempfile.TemporaryFile()
+        try:
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self.stderr)
+        except OSError:
+            pass
+
+    def isOpened(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def _error(self):
+        self.proc.wait()
+        self.stderr.seek(0)
+        message = self.stderr.read().decode(errors="replace").strip()
+        return RuntimeError(f"ffmpeg {self.encoder} exited with code {self.proc.returncode}: {message}")
+
+    def write(self, frame):
+        try:
+            self.proc.stdin.write(np.ascontiguousarray(frame))
+        except BrokenPipeError:
+            raise self._error() from None
+
+    def release(self):
+        if not self.has_session:
+            return
+        try:
+            if self.proc is None:
+                return
+            if not self.proc.stdin.closed:
+                try:
+                    self.proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+            if self.proc.wait() != 0:
+                raise self._error()
+        finally:
+            self.stderr.close()
+            self.has_session = False
+            _release_hw_session()
+
+
+def choose_encoder(size, is_color=True):
+    # Return the hardware encoder that accepts frames of this size, or None for software encoding
+    encoder = detect_hw_encoder()
+    if encoder is not None and encoder_works(encoder, *size, "bgr24" if is_color else "gray"):
+        return encoder
+    return None
+
+
+def open_video_writer(path, fps, size, is_color=True, encoder=AUTO_ENCODER):
+    # Open an H.264 writer. With AUTO_ENCODER a hardware encoder is preferred, falling back to
+    # OpenCV's FFmpeg backend when the encoder rejects this frame size or no hardware session is
+    # free. Otherwise encoder names the hardware encoder to use, or is None for OpenCV's backend;
+    # a named encoder that cannot be opened raises RuntimeError instead of falling back, so files
+    # that are joined later are all encoded the same way
+    required = encoder != AUTO_ENCODER
+    if not required:
+        encoder = choose_encoder(size, is_color)
+    if encoder is not None:
+        writer = FFmpegWriter(path, encoder, fps, size, is_color)
+        if writer.isOpened():
+            return writer
+        try:
+            writer.release()
+        except RuntimeError:
+            pass
+        if required:
+            raise RuntimeError(f"Could not open the {encoder} encoder for {path}")
+    return _open_cv_writer(path, 'avc1', fps, size, is_color)
+
+
+class EvenSizeWriter:
+    # Wraps a cv2.VideoWriter opened at even dimensions. OpenCV's FFmpeg backend silently drops
+    # the last row or column of odd-sized frames, so frames are padded with zeros on the right
+    # and bottom instead, like PAD_EVEN does for the ffmpeg writers
+    def __init__(self, writer, size, is_color):
+        self.writer = writer
+        self.width, self.height = size
+        shape = (self.height + self.height % 2, self.width + self.width % 2) + ((3,) if is_color else ())
+        self.frame_buf = np.zeros(shape, dtype=np.uint8)
+
+    def isOpened(self):
+        return self.writer.isOpened()
+
+    def write(self, frame):
+        self.frame_buf[:self.height, :self.width] = frame
+        self.writer.write(self.frame_buf)
+
+    def release(self):
+        self.writer.release()
+
+
+def _open_cv_writer(path, codec, fps, size, is_color):
+    # Open an OpenCV FFmpeg writer, padding odd frame sizes to even ones
+    width, height = size
+    even_size = (width + width % 2, height + height % 2)
+    writer = cv2.VideoWriter(path, cv2.CAP_FFMPEG, cv2.VideoWriter_fourcc(*codec), fps, even_size, isColor=is_color)
+    if even_size == (width, height):
+        return writer
+    return EvenSizeWriter(writer, size, is_color)
+
+
+def open_lossless_writer(path, fps, size, is_color=False):
+    # FFV1 is intra-only and lossless, cheap to encode and bit-exact for binary masks.
+    # Odd sizes gain a zero row or column on the bottom or right
+    return _open_cv_writer(path, 'FFV1', fps, size, is_color)